@@ -4,37 +4,97 @@ Functions to make a difxcalc input file (.calc) given telescope locations,
 times, sources, and other parameters in astropy classes.
 """
 
+import io
+from itertools import chain
 import numpy as np
-import warnings
-from datetime import datetime
-from astropy.time import Time, TimeDelta
-from astropy.utils import data
+from astropy.time import TimeDelta
 from astropy.utils import iers
 import astropy.coordinates as ac
 from astropy import units as un
-from astropy.constants import c as speed_of_light
-from multiprocessing import Process
-import pylab as pl
 
 
-# Up to date EOPs and leap second tables from the IERS
+# Up to date EOPs from the IERS
+
+# The EOP table is fetched on first use, since getting it may require
+# a download.
+_iers_tab = None
+
+
+def _get_iers_tab():
+    global _iers_tab
+    if _iers_tab is None:
+        _iers_tab = iers.earth_orientation_table.get()
+    return _iers_tab
 
-iers_tab = iers.earth_orientation_table.get()
 
 def _get_leap_seconds(tobj):
-    # Find current TAI - UTC for a given time.
-    lsec_table = iers.LeapSeconds.auto_open().as_array()
-    for ti, (yr, mo, tai_utc) in enumerate(lsec_table):
-        dtobj = datetime(yr, mo, 1, 0, 0, 0)
-        if dtobj > tobj.datetime:
-            ti -= 1
-            break
+    # Find current TAI - UTC for a given time or array of times, using the
+    # leap second table astropy already keeps for scale conversions.
+    # Subtracting the two Times directly would convert both to one scale,
+    # so difference their Julian dates instead.
+    tai, utc = tobj.tai, tobj.utc
+    return ((tai.jd1 - utc.jd1) + (tai.jd2 - utc.jd2)) * 86400.0
+
+
+_MINUTES_PER_DAY = 24 * 60
+
+# Offsets of the EOP entries from the start time.
+_EOP_TDELTA = TimeDelta(np.arange(2), format='jd')
+
+
+# Per-record templates for the repeated blocks of the calc file.
+_EOP_TMPL = (
+    "EOP %d TIME (mjd):   %.0f\n"
+    "EOP %d TAI_UTC (sec):%.0f\n"
+    "EOP %d UT1_UTC (sec): %.10f\n"
+    "EOP %d XPOLE (arcsec): %.10f\n"
+    "EOP %d YPOLE (arcsec): %.10f\n"
+)
+
+# RA and Dec are in radians.
+_SOURCE_TMPL = (
+    "SOURCE %d NAME:      %s\n"
+    "SOURCE %d RA:        %.8f\n"
+    "SOURCE %d DEC:       %.8f\n"
+    "SOURCE %d CALCODE:   B\n"
+    "SOURCE %d QUAL:      0\n"
+)
+
+_TELESCOPE_TMPL = (
+    "TELESCOPE %d NAME:   %s\n"
+    "TELESCOPE %d MOUNT:  AZEL\n"
+    "TELESCOPE %d OFFSET (m): 0.0000\n"
+    "TELESCOPE %d X (m): %.8f\n"
+    "TELESCOPE %d Y (m): %.8f\n"
+    "TELESCOPE %d Z (m): %.8f\n"
+    "TELESCOPE %d SHELF:  None\n"
+)
+
+
+def _write_lines(buf, lines):
+    # Write each line to buf, newline-terminated.
+    for line in lines:
+        buf.write(line)
+        buf.write('\n')
 
-    if tobj.datetime.year < 1960:
-        return 0.0
 
-    (_, _, tai_utc) = lsec_table[ti]
-    return tai_utc
+def _write_records(buf, tmpl, rows):
+    # Write one record per row, each row holding the template fields in
+    # order. The whole block is formatted by a single % on the repeated
+    # template, so the per-field conversions all happen in C.
+    rows = list(rows)
+    fields = tuple(chain.from_iterable(rows))
+    buf.write((tmpl * len(rows)) % fields)
+
+
+def _default_im_filename(ofile_name):
+    # Name the .im file after the .calc file, replacing a .calc extension.
+    ls = ofile_name.split('.')
+    im_filename = ofile_name + '.im'
+    if ls[-1] == 'calc':
+        ls.pop()
+        im_filename = ".".join(ls) + '.im'
+    return im_filename
 
 
 def make_calc(telescope_positions, telescope_names, source_coords,
@@ -46,11 +106,14 @@ def make_calc(telescope_positions, telescope_names, source_coords,
     Parameters
     ----------
     telescope_positions: list of astropy.coordinates.EarthLocation
-        Positions of telescopes on the Earth.
+        Positions of telescopes on the Earth. May also be given as a single
+        array EarthLocation.
     telescope_names: list of str
         Corresponding telescope names. These must be unique.
     source_coords: list of astropy.coordinates.SkyCoord
-        Source positions to include.
+        Source positions to include. May also be given as a single
+        array SkyCoord. If the sources are in different frames, they are
+        all converted to ICRS.
     source_names: list of str
         Names of sources in the list.
     time: astropy.time.Time
@@ -68,122 +131,171 @@ def make_calc(telescope_positions, telescope_names, source_coords,
     if ofile_name is None:
         ofile_name = 'new.calc'
     if im_filename is None:
-        ls = ofile_name.split('.')
-        im_filename = ofile_name + '.im'
-        if ls[-1] == 'calc':
-            ls.pop()
-            im_filename = ".".join(ls) + '.im'
+        im_filename = _default_im_filename(ofile_name)
 
-    # ----------------------------
-    # Start time and job params.
-    # ----------------------------
-    lines = []
-    newlines = [
-        "JOB ID:             4",
-        "JOB START TIME:     {:.8f}".format(time.mjd),
-        "JOB STOP TIME:      {:.8f}".format(time.mjd + duration_min / (24 * 60)),
-        "DUTY CYCLE:         1.000",
-        "OBSCODE:            DUMMY",
-        "DIFX VERSION:       DIFX-2.6.2",
-        "DIFX LABEL:         VLBADIFX-2.6.2",
-        "SUBJOB ID:          0",
-        "SUBARRAY ID:        0",
-        "VEX FILE:           dummy.vex.obs",
-        "START MJD:          {:.8f}".format(time.mjd),
-        "START YEAR:         {:.0f}".format(time.datetime.year),
-        "START MONTH:        {:.0f}".format(time.datetime.month),
-        "START DAY:          {:.0f}".format(time.datetime.day),
-        "START HOUR:         {:.0f}".format(time.datetime.hour),
-        "START MINUTE:       {:.0f}".format(time.datetime.minute),
-        "START SECOND:       {:.0f}".format(time.datetime.second),
-        "IM FILENAME:        dummy.im",
-        "FLAG FILENAME:      dummy.flag",
-
-    ]
-    lines.extend(newlines)
+    make_calc_bulk(telescope_positions, telescope_names, source_coords,
+                   source_names, time.reshape(1), duration_min, [ofile_name],
+                   im_filenames=[im_filename])
+
+
+def make_calc_bulk(telescope_positions, telescope_names, source_coords,
+                   source_names, times, duration_min, ofile_names,
+                   im_filenames=None):
+    """
+    Make one .calc file per start time, for the same telescopes and sources.
+
+    The source and telescope blocks are formatted once and the EOPs for all
+    files are looked up together, so this is faster than calling make_calc
+    for each time.
+
+    Parameters
+    ----------
+    telescope_positions: list of astropy.coordinates.EarthLocation
+        Positions of telescopes on the Earth. May also be given as a single
+        array EarthLocation.
+    telescope_names: list of str
+        Corresponding telescope names. These must be unique.
+    source_coords: list of astropy.coordinates.SkyCoord
+        Source positions to include. May also be given as a single
+        array SkyCoord. If the sources are in different frames, they are
+        all converted to ICRS.
+    source_names: list of str
+        Names of sources in the list.
+    times: astropy.time.Time
+        1D array of observation start times, one per file.
+    duration_min: float
+        Duration of each observation in minutes.
+    ofile_names: list of str
+        Output .calc file names, one per time.
+    im_filenames: list of str
+        Names of the .im files to be produced by difxcalc.
+        Defaults to the .calc file names with a .im extension.
+    """
+    if len(ofile_names) != len(times):
+        raise ValueError("Need one output file name per time.")
+    if im_filenames is None:
+        im_filenames = [_default_im_filename(name) for name in ofile_names]
+    if len(im_filenames) != len(times):
+        raise ValueError("Need one .im file name per time.")
+
+    # Telescope positions as a single array EarthLocation.
+    if not isinstance(telescope_positions, ac.EarthLocation):
+        # Quantity cannot stack a list of (x, y, z) tuples directly, so
+        # build each axis on its own.
+        geocentric = [pos.geocentric for pos in telescope_positions]
+        telescope_positions = ac.EarthLocation.from_geocentric(
+            *(un.Quantity(axis) for axis in zip(*geocentric))
+        )
 
     # ----------------------------
     # Earth Orientation Parameters
     # ----------------------------
-    tai_utc = []
-    ut1_utc = []
-    mjd = []
-    xy = []
-    times = time + TimeDelta(range(2), format='jd')
-    for tt in times:
-        mjd.append(np.floor(tt.mjd))
-        tai_utc.append(_get_leap_seconds(tt))
-        ut1_utc.append(tt.delta_ut1_utc.reshape(1)[0])
-
-        # polar motion
-        xy.append([z.to_value('arcsec') for z in iers_tab.pm_xy(tt)])
-
-    lines.append("NUM EOPS: {:d}".format(len(times)))
-    for ti in range(len(times)):
-        newlines = [
-            "EOP {:d} TIME (mjd):   {:.0f}".format(ti, mjd[ti]),
-            "EOP {:d} TAI_UTC (sec):{:.0f}".format(ti, tai_utc[ti]),
-            "EOP {:d} UT1_UTC (sec): {:.10f}".format(ti, ut1_utc[ti]),
-            "EOP {:d} XPOLE (arcsec): {:.10f}".format(ti, xy[ti][0]),
-            "EOP {:d} YPOLE (arcsec): {:.10f}".format(ti, xy[ti][1]),
-        ]
-        lines.extend(newlines)
+    iers_tab = _get_iers_tab()
+    # Shape (number of files, number of EOPs per file).
+    eop_times = times.reshape(-1, 1) + _EOP_TDELTA
+    mjd = np.floor(eop_times.mjd)
+    tai_utc = _get_leap_seconds(eop_times)
+    ut1_utc = iers_tab.ut1_utc(eop_times).to_value('s')
+
+    # polar motion
+    xpole, ypole = [z.to_value('arcsec') for z in iers_tab.pm_xy(eop_times)]
 
     # ----------------------------
     # Sources
     # ----------------------------
     # CALCODE = calibration code, typicallyA,B,Cfor calibrators,Gfor a gated pulsar, or blank for normal target
     # https://www.atnf.csiro.au/vlbi/dokuwiki/lib/exe/fetch.php/difx/difxuserguide.pdf  
-    lines.append("NUM SOURCES: {:d}".format(len(source_names)))
-    for si, (coord, name) in enumerate(zip(source_coords, source_names)):
-        newlines = [
-            "SOURCE {:d} NAME:      {}".format(si, name),
-            "SOURCE {:d} RA:        {:.8f}".format(si, coord.ra.rad),      # radians
-            "SOURCE {:d} DEC:       {:.8f}".format(si, coord.dec.rad),      # radians
-            "SOURCE {:d} CALCODE:   B".format(si),
-            "SOURCE {:d} QUAL:      0".format(si),
-        ]
-        lines.extend(newlines)
+    buf = io.StringIO()
+    if not isinstance(source_coords, ac.SkyCoord):
+        # A list in mixed frames cannot be stacked as is.
+        first = source_coords[0]
+        if not all(coord.is_equivalent_frame(first) for coord in source_coords):
+            source_coords = [coord.icrs for coord in source_coords]
+        source_coords = ac.SkyCoord(source_coords)
+    ras = source_coords.ra.rad.tolist()
+    decs = source_coords.dec.rad.tolist()
+    buf.write("NUM SOURCES: %d\n" % len(source_names))
+    rows = ((i, name, i, ra, i, dec, i, i)
+            for i, (name, ra, dec) in enumerate(zip(source_names, ras, decs)))
+    _write_records(buf, _SOURCE_TMPL, rows)
+    source_block = buf.getvalue()
 
     # ----------------------------
     # Telescopes
     # ----------------------------
+    buf = io.StringIO()
     n_ants = len(telescope_names)
-    lines.append("NUM TELESCOPES:     {}".format(n_ants))
-    for ti in range(n_ants):
-        newlines=[
-            "TELESCOPE {:d} NAME:   {}".format(ti, telescope_names[ti]),
-            "TELESCOPE {:d} MOUNT:  AZEL".format(ti),
-            "TELESCOPE {:d} OFFSET (m): 0.0000".format(ti),
-            "TELESCOPE {:d} X (m): {:.8f}".format(ti, telescope_positions[ti].x.to_value('m')),
-            "TELESCOPE {:d} Y (m): {:.8f}".format(ti, telescope_positions[ti].y.to_value('m')),
-            "TELESCOPE {:d} Z (m): {:.8f}".format(ti, telescope_positions[ti].z.to_value('m')),
-            "TELESCOPE {:d} SHELF:  None".format(ti),
+    xs, ys, zs = (q.to_value('m').tolist() for q in telescope_positions.geocentric)
+    buf.write("NUM TELESCOPES:     %d\n" % n_ants)
+    rows = ((i, name, i, i, i, x, i, y, i, z, i)
+            for i, (name, x, y, z) in enumerate(zip(telescope_names, xs, ys, zs)))
+    _write_records(buf, _TELESCOPE_TMPL, rows)
+    telescope_block = buf.getvalue()
+
+    start_mjds = times.mjd
+    stop_mjds = start_mjds + duration_min / _MINUTES_PER_DAY
+    files = zip(ofile_names, im_filenames, start_mjds, stop_mjds, times.datetime)
+    for fi, (ofile_name, im_filename, mjd0, stop_mjd, dt) in enumerate(files):
+        # ----------------------------
+        # Start time and job params.
+        # ----------------------------
+        buf = io.StringIO()
+        newlines = [
+            "JOB ID:             4",
+            "JOB START TIME:     %.8f" % mjd0,
+            "JOB STOP TIME:      %.8f" % stop_mjd,
+            "DUTY CYCLE:         1.000",
+            "OBSCODE:            DUMMY",
+            "DIFX VERSION:       DIFX-2.6.2",
+            "DIFX LABEL:         VLBADIFX-2.6.2",
+            "SUBJOB ID:          0",
+            "SUBARRAY ID:        0",
+            "VEX FILE:           dummy.vex.obs",
+            "START MJD:          %.8f" % mjd0,
+            "START YEAR:         %.0f" % dt.year,
+            "START MONTH:        %.0f" % dt.month,
+            "START DAY:          %.0f" % dt.day,
+            "START HOUR:         %.0f" % dt.hour,
+            "START MINUTE:       %.0f" % dt.minute,
+            "START SECOND:       %.0f" % dt.second,
+            "IM FILENAME:        dummy.im",
+            "FLAG FILENAME:      dummy.flag",
+
         ]
-        lines.extend(newlines)
+        _write_lines(buf, newlines)
 
-    # ----------------------------
-    # Other necessary attributes.
-    # ----------------------------
-    other = [
-        "SPECTRAL AVG:       1",
-        "TAPER FUNCTION:     UNIFORM",
-        "NUM SCANS:          1",
-        "SCAN 0 IDENTIFIER:  No0004",
-        "SCAN 0 START (S):   0",
-        "SCAN 0 DUR (S):     {}".format(duration_min * 60),
-        "SCAN 0 OBS MODE NAME:JWST",
-        "SCAN 0 UVSHIFT INTERVAL (NS):2000000000",
-        "SCAN 0 AC AVG INTERVAL (NS):2000000",
-        "SCAN 0 POINTING SRC:0",
-        "SCAN 0 NUM PHS CTRS:1",
-        "SCAN 0 PHS CTR 0:   0",
-        "NUM SPACECRAFT:     0",
-        "IM FILENAME:        {}".format(im_filename),
-        "FLAG FILENAME:      {}".format(im_filename + '.flag'),
-    ]
-    lines.extend(other)
-
-    lines = [l + '\n' for l in lines]
-    with open(ofile_name, 'w') as ofile:
-        ofile.writelines(lines)
+        n_eops = len(_EOP_TDELTA)
+        buf.write("NUM EOPS: %d\n" % n_eops)
+        eops = zip(mjd[fi].tolist(), tai_utc[fi].tolist(), ut1_utc[fi].tolist(),
+                   xpole[fi].tolist(), ypole[fi].tolist())
+        rows = ((i, mjd_i, i, tai_i, i, ut1_i, i, xp_i, i, yp_i)
+                for i, (mjd_i, tai_i, ut1_i, xp_i, yp_i) in enumerate(eops))
+        _write_records(buf, _EOP_TMPL, rows)
+
+        buf.write(source_block)
+        buf.write(telescope_block)
+
+        # ----------------------------
+        # Other necessary attributes.
+        # ----------------------------
+        other = [
+            "SPECTRAL AVG:       1",
+            "TAPER FUNCTION:     UNIFORM",
+            "NUM SCANS:          1",
+            "SCAN 0 IDENTIFIER:  No0004",
+            "SCAN 0 START (S):   0",
+            "SCAN 0 DUR (S):     %s" % (duration_min * 60),
+            "SCAN 0 OBS MODE NAME:JWST",
+            "SCAN 0 UVSHIFT INTERVAL (NS):2000000000",
+            "SCAN 0 AC AVG INTERVAL (NS):2000000",
+            "SCAN 0 POINTING SRC:0",
+            "SCAN 0 NUM PHS CTRS:1",
+            "SCAN 0 PHS CTR 0:   0",
+            "NUM SPACECRAFT:     0",
+            "IM FILENAME:        %s" % im_filename,
+            "FLAG FILENAME:      %s.flag" % im_filename,
+        ]
+        _write_lines(buf, other)
+
+        with open(ofile_name, 'w', buffering=1 << 20) as ofile:
+            ofile.write(buf.getvalue())
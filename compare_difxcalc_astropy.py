@@ -22,20 +22,24 @@ ip_peg = ac.SkyCoord("23:23:08.55", "+18:24:59.3", unit=(un.hourangle, un.deg),
 # choose a source to use.
 src = crab
 
+# Stations, as one array EarthLocation shared by astropy and the calc file.
+telescope_positions = ac.EarthLocation.from_geocentric(
+    *(un.Quantity(axis) for axis in zip(chime_loc.geocentric, gbo_loc.geocentric))
+)
+telescope_names = ['chime', 'gbo']
+
 t0 = time + TimeDelta(1, format='sec')
-t1 = t0.copy()
-t0.location = gbo_loc
-t1.location = chime_loc
-ltt0 = t0.light_travel_time(src, ephemeris='jpl')
-ltt1 = t1.light_travel_time(src, ephemeris='jpl')
 
-astr_delay = (ltt1 - ltt0).to_value('us')
+# Evaluate both stations in a single call, so the JPL ephemeris and
+# astrometry setup are shared between them.
+with ac.solar_system_ephemeris.set('jpl'):
+    ltts = Time([t0, t0]).light_travel_time(src, location=telescope_positions)
+
+astr_delay = (ltts[0] - ltts[1]).to_value('us')
 
 
 # Make a calc file
 calcname = "new.calc"
-telescope_positions = [chime_loc, gbo_loc]
-telescope_names = ['chime', 'gbo']
 source_coords = [src]
 source_names = ['src']
 duration_min = 4